@@ -3,55 +3,197 @@ from datetime import datetime
 import pytz
 from PIL import Image
 import io
+import hashlib
+import logging
+import os
+import queue
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
 
 # Handle optional imports gracefully
 try:
     import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
+    from gspread.utils import rowcol_to_a1
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
     GSPREAD_AVAILABLE = True
 except ImportError:
-    st.error("❌ Google Sheets integration not available. Please install: pip install gspread oauth2client")
+    st.error("❌ Google Sheets integration not available. Please install: pip install gspread google-auth")
     GSPREAD_AVAILABLE = False
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import zxingcpp
+    ZXING_AVAILABLE = True
+except ImportError:
+    ZXING_AVAILABLE = False
+
 try:
     import cv2
+    # Keep OpenCV's internal parallelism modest on a shared Streamlit host
+    cv2.setNumThreads(2)
     CV2_AVAILABLE = True
 except ImportError:
-    st.warning("⚠️ OpenCV not available. QR detection may be limited. Install with: pip install opencv-python-headless")
+    st.warning("⚠️ OpenCV not available. QR detection may be limited. Install with: pip install opencv-contrib-python-headless")
     CV2_AVAILABLE = False
 
 # ========================
 # QR CODE DETECTION FUNCTIONS  
 # ========================
 
-def detect_qr_with_opencv(image):
-    """Try to detect QR code using OpenCV"""
+QR_MAX_SIDE = 1024  # Longest image side passed to the QR detector
+QR_MIN_CONTRAST = 15  # Grayscale std-dev below which a frame can't hold a readable QR
+
+@st.cache_resource
+def _get_qr_detector():
+    """Create the OpenCV QR detector once and reuse it across reruns"""
+    return cv2.QRCodeDetector()
+
+# Optional super-resolution/CNN models for the WeChat detector
+# Resolved next to app.py so `streamlit run` works from any working directory
+WECHAT_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wechat_qrcode")
+WECHAT_MODEL_FILES = ("detect.prototxt", "detect.caffemodel", "sr.prototxt", "sr.caffemodel")
+
+@st.cache_resource
+def _get_wechat_detector():
+    """Create the WeChat QR detector if this OpenCV build ships it (opencv-contrib)"""
+    # Some builds only expose the flat binding name
+    wechat_cls = getattr(getattr(cv2, "wechat_qrcode", None), "WeChatQRCode", None) \
+        or getattr(cv2, "wechat_qrcode_WeChatQRCode", None)
+    if wechat_cls is None:
+        return None
+    try:
+        model_paths = [os.path.join(WECHAT_MODEL_DIR, f) for f in WECHAT_MODEL_FILES]
+        if all(os.path.exists(p) for p in model_paths):
+            return wechat_cls(*model_paths)
+        # Without model files it still runs, using the traditional finder
+        return wechat_cls()
+    except Exception:
+        return None
+
+@st.cache_resource
+def _get_decode_pool():
+    """Single QR decode worker shared by every session.
+
+    The script thread still waits on each result, so this doesn't free the UI;
+    it caps decoding at one image at a time, and concurrent scans from several
+    stations queue behind each other."""
+    return ThreadPoolExecutor(max_workers=1)
+
+def _detect_qr_gray(gray, wechat_detector, qr_detector):
+    """Detect and decode a QR code in a single-channel image"""
+    # Downscale large camera frames to ~1024px on the long side
+    h, w = gray.shape[:2]
+    scale = QR_MAX_SIDE / max(h, w)
+    small = gray
+    if scale < 1:
+        small = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+    # Skip blank, covered or very dark frames before the expensive detectors
+    if small.std() < QR_MIN_CONTRAST:
+        return None
+
+    # zxing-cpp is the fastest decoder when installed
+    if ZXING_AVAILABLE:
+        results = zxingcpp.read_barcodes(small, formats=zxingcpp.BarcodeFormat.QRCode)
+        if results and results[0].text:
+            return results[0].text
+
+    # Then the WeChat detector; it copes better with blurry phone photos
+    if wechat_detector is not None:
+        texts, points = wechat_detector.detectAndDecode(small)
+        if texts and texts[0]:
+            return texts[0]
+
+    # Detect and decode QR code
+    data, vertices_array, binary_qrcode = qr_detector.detectAndDecode(small)
+
+    # Fall back to the frame as decoded for small/dense codes (for large JPEGs
+    # that is the DCT-reduced size, still at least QR_MAX_SIDE on the long side)
+    if not data and small is not gray:
+        data, vertices_array, binary_qrcode = qr_detector.detectAndDecode(gray)
+
+    if data:
+        return data
+    return None
+
+def _decode_gray(gray):
+    """Run _detect_qr_gray on the decode worker with the cached detectors"""
+    # Detectors are resolved here so the worker never touches Streamlit's cache;
+    # the single worker also serialises use of the shared detector instances
+    future = _get_decode_pool().submit(_detect_qr_gray, gray, _get_wechat_detector(), _get_qr_detector())
+    return future.result()
+
+def _grayscale_decode_flag(raw):
+    """Pick the largest JPEG DCT-domain reduction that keeps the long side >= QR_MAX_SIDE"""
+    try:
+        # Image.open only parses the header here; pixels are never decoded
+        header = Image.open(io.BytesIO(raw))
+        w, h = header.size
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE
+    # Other formats (PNG) are decoded at full size and resized afterwards, which saves nothing
+    if header.format != "JPEG":
+        return cv2.IMREAD_GRAYSCALE
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                         (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                         (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+        if max(w, h) // factor >= QR_MAX_SIDE:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+def detect_qr_from_bytes(raw):
+    """Detect QR code straight from encoded image bytes (JPEG/PNG)"""
     if not CV2_AVAILABLE:
         st.error("OpenCV not available for QR detection")
         return None
-        
+
     try:
-        # Convert PIL image to OpenCV format
-        img_array = np.array(image)
-        
-        # Initialize QR code detector
-        qr_detector = cv2.QRCodeDetector()
-        
-        # Detect and decode QR code
-        data, vertices_array, binary_qrcode = qr_detector.detectAndDecode(img_array)
-        
-        if data:
-            return data
-        return None
+        # Decode directly to grayscale, skipping the PIL and RGB round trip;
+        # large JPEGs are scaled down inside libjpeg rather than after a full decode
+        gray = cv2.imdecode(np.frombuffer(raw, np.uint8), _grayscale_decode_flag(raw))
+        if gray is None:
+            return None
+        return _decode_gray(gray)
     except Exception as e:
         st.error(f"OpenCV detection error: {e}")
         return None
 
+def image_digest(raw):
+    """Short content hash identifying a captured/uploaded image"""
+    return hashlib.blake2b(raw, digest_size=8).hexdigest()
+
+def decode_qr_once(raw, digest, state_key):
+    """Decode image bytes, reusing the last result when the same image reappears"""
+    # Reruns resend the same captured image; a short hash is far cheaper than a decode
+    last = st.session_state.get(state_key)
+    if last and last[0] == digest:
+        return last[1]
+    qr_data = detect_qr_from_bytes(raw)
+    st.session_state[state_key] = (digest, qr_data)
+    return qr_data
+
 # ========================
 # GOOGLE SHEETS CONNECTION
 # ========================
 
+def _orjson_response_hook(response, *args, **kwargs):
+    """Parse Sheets API responses with orjson instead of the stdlib json module"""
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
 @st.cache_resource
 def init_google_sheets():
     """Initialize Google Sheets connection using st.secrets only"""
@@ -70,15 +212,31 @@ def init_google_sheets():
             **Setup Instructions:**
             1. Go to Streamlit Cloud → Your App → Settings → Secrets
             2. Add your service account JSON under key `gcp_service_account`
-            3. Redeploy your app
+            3. Optionally add the spreadsheet ID under key `sheet_id`
+            4. Redeploy your app
             """)
             return None
             
         creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
+        
+        # Keep-alive connection pool with retry/backoff shared by all API calls.
+        # Quota (429) and transient 5xx responses are retried too; POST is included
+        # because the only one sent is the idempotent values:batchUpdate exit write.
+        session = AuthorizedSession(creds)
+        retry = Retry(total=5, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=retry)
+        session.mount("https://", adapter)
+        if ORJSON_AVAILABLE:
+            session.hooks["response"].append(_orjson_response_hook)
         
-        client = gspread.authorize(creds)
-        sheet = client.open("orientation_passes").sheet1
+        client = gspread.Client(auth=creds, session=session)
+        # Opening by key skips the Drive search that opening by name needs
+        if "sheet_id" in st.secrets:
+            sheet = client.open_by_key(st.secrets["sheet_id"]).sheet1
+        else:
+            sheet = client.open("orientation_passes").sheet1
         return sheet
         
     except FileNotFoundError as e:
@@ -97,24 +255,138 @@ def init_google_sheets():
         """)
         return None
 
+SHEET_CACHE_TTL = 15  # Seconds before records and the header map are re-fetched
+
+@st.cache_data(ttl=SHEET_CACHE_TTL, show_spinner=False)
+def _load_records(sheet_key):
+    """Fetch all sheet records as a DataFrame plus an ID -> sheet row index,
+    cached briefly so reruns share one API call"""
+    df = pd.DataFrame(init_google_sheets().get_all_records())
+    if "EntryTime" in df:
+        # Parse the whole column once; blank/malformed cells become NaT
+        df["EntryTime"] = pd.to_datetime(df["EntryTime"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    if "ID" in df:
+        # Normalise IDs to stripped strings once so lookups are a plain dict hit
+        df["ID"] = df["ID"].astype(str).str.strip()
+        # First occurrence wins for duplicate IDs, like a top-down row scan
+        first_rows = df.drop_duplicates("ID")
+        id_index = dict(zip(first_rows["ID"], (first_rows.index + 2).tolist()))
+    else:
+        id_index = {}
+    return df, id_index
+
+@st.cache_data(ttl=SHEET_CACHE_TTL, show_spinner=False)
+def _load_column_map(sheet_key):
+    """Map header names to 1-based column numbers, re-read so inserted or
+    reordered columns are picked up"""
+    headers = init_google_sheets().row_values(1)
+    return {name: col for col, name in enumerate(headers, start=1) if name}
+
+@st.cache_resource
+def _get_write_executor():
+    """Single background worker that pushes exit writes to Google Sheets"""
+    return ThreadPoolExecutor(max_workers=1)
+
+@st.cache_resource
+def _get_write_queue():
+    """Exit cell updates waiting for the write worker: (student ID, updates)"""
+    return queue.Queue()
+
+@st.cache_resource
+def _get_pending_exits():
+    """Exits submitted but not yet seen in loaded records: ID -> exit time"""
+    return {}
+
+@st.cache_resource
+def _get_failed_exits():
+    """Exits whose sheet write failed and still need a rescan: ID -> exit time"""
+    return {}
+
+def _get_records(sheet):
+    """Cached records with any in-flight exits applied on top"""
+    # cache_data hands back a fresh copy, so patching it here is safe
+    df, id_index = _load_records(sheet.spreadsheet.id)
+    # Failed writes the sheet shows anyway (fixed by hand, recorded by another
+    # station, or applied despite an error response) need no rescan
+    failed = _get_failed_exits()
+    for student_id in list(failed):
+        i = id_index.get(student_id)
+        if i is not None and df.at[i - 2, "ExitStatus"]:
+            failed.pop(student_id, None)
+    pending = _get_pending_exits()
+    for student_id, exit_time in list(pending.items()):
+        i = id_index.get(student_id)
+        if i is None:
+            continue
+        if df.at[i - 2, "ExitStatus"]:
+            # The sheet itself shows the exit now; a fetch that raced the
+            # write can no longer hide it, so the mark can go
+            pending.pop(student_id, None)
+        else:
+            df.loc[i - 2, ["ExitStatus", "ExitTime"]] = ["Exited", exit_time]
+    return df, id_index
+
+def _submit_exit_write(sheet, student_id, i, now):
+    """Mark the exit locally and write it to the sheet off the script thread"""
+    columns = _load_column_map(sheet.spreadsheet.id)
+    missing = [name for name in ("ExitStatus", "ExitTime") if name not in columns]
+    if missing:
+        # Don't keep a bad header cached; the next scan re-reads it
+        _load_column_map.clear()
+        raise ValueError(f"Sheet header is missing column(s): {', '.join(missing)}")
+    updates = [
+        {"range": rowcol_to_a1(i, columns["ExitStatus"]), "values": [["Exited"]]},
+        {"range": rowcol_to_a1(i, columns["ExitTime"]), "values": [[now]]},
+    ]
+    pending = _get_pending_exits()
+    pending[student_id] = now
+
+    write_queue = _get_write_queue()
+    write_queue.put((student_id, updates))
+    _get_write_executor().submit(_flush_exit_writes, sheet, write_queue, pending, _get_failed_exits())
+
+def _flush_exit_writes(sheet, write_queue, pending, failed):
+    """Drain every queued exit and send them to the sheet in one batch_update"""
+    batch = []
+    while True:
+        try:
+            batch.append(write_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        return  # An earlier flush already sent these
+
+    student_ids = [student_id for student_id, _ in batch]
+    try:
+        # All queued ExitStatus/ExitTime cells in a single API call
+        sheet.batch_update([u for _, updates in batch for u in updates],
+                           value_input_option="USER_ENTERED")
+        # Pending marks stay until _get_records sees the exit in a fresh load
+        _load_records.clear()
+        for student_id in student_ids:
+            failed.pop(student_id, None)
+    except Exception:
+        # No UI from a worker thread; the failed map is shown by the stats panel
+        # and on the next scan, and dropping the pending marks lets students rescan
+        logger.exception("Failed to record exits for %s", ", ".join(student_ids))
+        for student_id in student_ids:
+            failed[student_id] = pending.pop(student_id, None)
+
+IST = pytz.timezone('Asia/Kolkata')
+
 def get_ist_time():
     """Get current time in IST"""
-    ist = pytz.timezone('Asia/Kolkata')
-    return datetime.now(ist)
-
-def format_ist_datetime():
-    """Format current IST datetime for database"""
-    return get_ist_time().strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.now(IST)
 
 def get_exit_statistics(sheet):
     """Get real-time exit statistics"""
     try:
-        records = sheet.get_all_records()
-        total_entries = sum(1 for row in records if row.get("EntryStatus") == "Entered")
-        total_exits = sum(1 for row in records if row.get("ExitStatus") == "Exited")
+        df, _ = _get_records(sheet)
+        total_entries = int(df["EntryStatus"].eq("Entered").sum()) if "EntryStatus" in df else 0
+        total_exits = int(df["ExitStatus"].eq("Exited").sum()) if "ExitStatus" in df else 0
+        total_students = len(df)
         currently_present = total_entries - total_exits
-        total_students = len(records)
-        
+
         return {
             "total_entries": total_entries,
             "total_exits": total_exits,
@@ -129,320 +401,350 @@ def get_exit_statistics(sheet):
             "total_students": "Error"
         }
 
+SCAN_DEBOUNCE_SECONDS = 5  # Ignore repeat scans of the same ID within this window
+STUDENT_ID_RE = re.compile(r"20\d{5}")  # 7 digits starting with 20, e.g. 2025001; checked before any Sheets call
+
 def process_student_exit(qr_data, sheet):
-    """Process the scanned student data for EXIT ONLY"""
+    """Process the scanned student data for EXIT ONLY; returns False on a database error,
+    so the caller leaves the image unprocessed and a retry goes through"""
+    # Normalise once; the ID index keys are stripped strings too
+    student_id = str(qr_data).strip()
+
+    # Skip accidental double-taps of the same QR code
+    last = st.session_state.get("last_scan")
+    if last and last[0] == student_id and time.time() - last[1] < SCAN_DEBOUNCE_SECONDS:
+        # last_scan is only set once an exit was submitted or found already recorded
+        st.info("✅ This student was just processed.")
+        return True
+
     try:
-        records = sheet.get_all_records()
-        found = False
+        df, id_index = _get_records(sheet)
+        i = id_index.get(student_id)
         
-        for i, row in enumerate(records, start=2):
-            if str(row["ID"]) == str(qr_data):
-                found = True
-                now = format_ist_datetime()  # Use IST time
-                
-                # Check if student has entered
-                entry_status = row.get("EntryStatus", "")
-                
-                if not entry_status:
-                    st.error(f"❌ **{row['Name']}** hasn't checked in yet!")
-                    st.info("Please check-in at the ENTRY SCANNER first.")
-                    return
-                
-                # Handle EXIT only
-                exit_status = row.get("ExitStatus", "")
-                
-                if not exit_status or exit_status == "":
-                    sheet.update_cell(i, 6, "Exited")   # ExitStatus column
-                    sheet.update_cell(i, 7, now)        # ExitTime column
-                    st.success(f"👋 **Thank you for attending!**")
-                    st.success(f"🚪 **Exit recorded** for **{row['Name']}**")
-                    st.info(f"📚 **Branch:** {row['Branch']}")
-                    st.info(f"🕐 **Exit Time:** {now}")
-                    
-                    # Calculate duration if entry time exists
-                    entry_time = row.get("EntryTime", "")
-                    if entry_time:
-                        try:
-                            # Parse entry time and calculate duration in IST
-                            entry_dt = datetime.strptime(entry_time, "%Y-%m-%d %H:%M:%S")
-                            exit_dt = datetime.strptime(now, "%Y-%m-%d %H:%M:%S")
-                            duration = exit_dt - entry_dt
-                            hours = duration.total_seconds() // 3600
-                            minutes = (duration.total_seconds() % 3600) // 60
-                            st.info(f"⏱️ **Total Duration:** {int(hours)}h {int(minutes)}m")
-                        except:
-                            pass
-                    
-                    # Show goodbye message
-                    st.markdown("""
-                    <div style="background: linear-gradient(135deg, #ff7b7b 0%, #667eea 100%); 
-                                color: white; padding: 20px; border-radius: 15px; 
-                                text-align: center; margin: 20px 0;">
-                        <h3>🎓 Thank You for Attending!</h3>
-                        <p>Your exit has been successfully recorded.</p>
-                        <p><strong>Safe journey home!</strong></p>
-                        <p>We hope you enjoyed the orientation program.</p>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                else:
-                    st.warning(f"⚠️ **{row['Name']}** has already checked out!")
-                    st.info(f"📅 **Previous Exit Time:** {row.get('ExitTime', 'Not recorded')}")
-                    st.info("✅ Exit was already recorded. Safe journey!")
-                
-                break
-        
-        if not found:
+        if i is None:
             st.error("❌ **Student ID not found** in records.")
             st.write("Please verify the QR code or contact the administrator.")
+            return True
+        
+        row = df.loc[i - 2]
+        # Naive IST timestamp, matching how entry times are stored
+        now_dt = get_ist_time().replace(tzinfo=None)
+        now = now_dt.strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Check if student has entered
+        entry_status = row.get("EntryStatus", "")
+        
+        if not entry_status:
+            st.error(f"❌ **{row['Name']}** hasn't checked in yet!")
+            st.info("Please check-in at the ENTRY SCANNER first.")
+            return True
+        
+        # Handle EXIT only
+        exit_status = row.get("ExitStatus", "")
+        
+        if not exit_status or exit_status == "":
+            if student_id in _get_failed_exits():
+                st.warning("⚠️ The previous exit for this student was **not saved** to the sheet. Recording it again.")
+            _submit_exit_write(sheet, student_id, i, now)
+            st.session_state["last_scan"] = (student_id, time.time())
+            st.success(f"👋 **Thank you for attending!**")
+            st.success(f"🚪 **Exit recorded** for **{row['Name']}**")
+            st.info(f"📚 **Branch:** {row['Branch']}")
+            st.info(f"🕐 **Exit Time:** {now}")
+            
+            # Calculate duration if entry time exists (parsed at load time)
+            entry_dt = row.get("EntryTime", pd.NaT)
+            if pd.notna(entry_dt):
+                try:
+                    # Calculate duration in IST
+                    duration = now_dt - entry_dt
+                    hours = duration.total_seconds() // 3600
+                    minutes = (duration.total_seconds() % 3600) // 60
+                    st.info(f"⏱️ **Total Duration:** {int(hours)}h {int(minutes)}m")
+                except:
+                    pass
+            
+            # Show goodbye message
+            st.markdown("""
+            <div style="background: linear-gradient(135deg, #ff7b7b 0%, #667eea 100%); 
+                        color: white; padding: 20px; border-radius: 15px; 
+                        text-align: center; margin: 20px 0;">
+                <h3>🎓 Thank You for Attending!</h3>
+                <p>Your exit has been successfully recorded.</p>
+                <p><strong>Safe journey home!</strong></p>
+                <p>We hope you enjoyed the orientation program.</p>
+            </div>
+            """, unsafe_allow_html=True)
+            
+        else:
+            _get_failed_exits().pop(student_id, None)
+            st.session_state["last_scan"] = (student_id, time.time())
+            st.warning(f"⚠️ **{row['Name']}** has already checked out!")
+            st.info(f"📅 **Previous Exit Time:** {row.get('ExitTime', 'Not recorded')}")
+            st.info("✅ Exit was already recorded. Safe journey!")
+        
+        return True
             
     except Exception as e:
+        # Nothing was recorded, so an immediate retry must not be debounced
+        st.session_state.pop("last_scan", None)
         st.error(f"**Database Error:** {e}")
         st.write("Please try again or contact technical support.")
+        return False
 
 # ========================
 # STREAMLIT UI
 # ========================
 
-def main():
-    st.set_page_config(
-        page_title="NRCM Exit Scanner", 
-        page_icon="🚪", 
-        layout="wide"
-    )
-    
-    # Custom CSS for better styling
-    st.markdown("""
-    <style>
-    .main-header {
-        text-align: center;
-        color: #FF5722;
-        font-size: 3rem;
-        margin-bottom: 0.5rem;
-        font-weight: bold;
-    }
-    .college-header {
-        text-align: center;
-        color: #2196F3;
-        font-size: 1.5rem;
-        margin-bottom: 1rem;
-        font-style: italic;
-    }
-    .exit-banner {
-        background: linear-gradient(135deg, #FF5722 0%, #E91E63 100%);
-        color: white;
-        padding: 25px;
-        border-radius: 15px;
-        text-align: center;
-        margin: 20px 0;
-        box-shadow: 0 4px 15px rgba(0,0,0,0.2);
-    }
-    .instruction-box {
-        background-color: #ffebee;
-        padding: 1rem;
-        border-radius: 0.5rem;
-        border-left: 4px solid #FF5722;
-        margin: 1rem 0;
-    }
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 2px;
-    }
-    .stTabs [data-baseweb="tab"] {
-        height: 50px;
-        padding-left: 20px;
-        padding-right: 20px;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Header
-    st.markdown('<h1 class="main-header">🚪 EXIT SCANNER</h1>', unsafe_allow_html=True)
-    st.markdown('<h2 class="college-header">Narsimha Reddy Engineering College</h2>', unsafe_allow_html=True)
-    
-    # Exit Banner
-    st.markdown("""
-    <div class="exit-banner">
-        <h2>👋 ORIENTATION DAY CHECK-OUT</h2>
-        <h3>📅 August 18th, 2025</h3>
-        <p><strong>Thank You for Attending!</strong> Scan your QR code to check-out.</p>
-        <p>🚪 <strong>This station is for EXIT ONLY</strong></p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    st.markdown("""
-    <div class="instruction-box">
-    📌 <strong>Exit Instructions:</strong><br>
-    1. <strong>Scan your student QR code</strong> to check-out<br>
-    2. Wait for confirmation message<br>
-    3. Thank you for attending orientation<br>
-    4. Safe journey home!<br>
-    5. For entry, use the <strong>ENTRY SCANNER</strong> at the main entrance
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # Initialize Google Sheets
-    if not GSPREAD_AVAILABLE:
-        st.error("❌ **Google Sheets integration not available**")
-        st.info("To enable Google Sheets functionality, please install required packages:")
-        st.code("pip install gspread oauth2client")
-        st.info("**For Streamlit Cloud:** Add these to your requirements.txt file")
-        st.stop()
-    
-    sheet = init_google_sheets()
-    if not sheet:
-        st.error("🔧 **Unable to connect to Google Sheets**")
-        st.info("""
-        **For Streamlit Cloud Setup:**
-        1. Go to your app dashboard
-        2. Click Settings → Secrets
-        3. Add your service account JSON under `gcp_service_account`
-        4. Redeploy the app
-        
-        **Service Account Setup:**
-        - Enable Google Sheets API and Google Drive API
-        - Share 'orientation_passes' sheet with service account email
-        - Ensure proper JSON format in secrets
-        """)
-        st.stop()
+# Static page chrome, built once at import and sent as a single markdown delta
+PAGE_CSS = """
+<style>
+.main-header {
+    text-align: center;
+    color: #FF5722;
+    font-size: 3rem;
+    margin-bottom: 0.5rem;
+    font-weight: bold;
+}
+.college-header {
+    text-align: center;
+    color: #2196F3;
+    font-size: 1.5rem;
+    margin-bottom: 1rem;
+    font-style: italic;
+}
+.exit-banner {
+    background: linear-gradient(135deg, #FF5722 0%, #E91E63 100%);
+    color: white;
+    padding: 25px;
+    border-radius: 15px;
+    text-align: center;
+    margin: 20px 0;
+    box-shadow: 0 4px 15px rgba(0,0,0,0.2);
+}
+.instruction-box {
+    background-color: #ffebee;
+    padding: 1rem;
+    border-radius: 0.5rem;
+    border-left: 4px solid #FF5722;
+    margin: 1rem 0;
+}
+.stTabs [data-baseweb="tab-list"] {
+    gap: 2px;
+}
+.stTabs [data-baseweb="tab"] {
+    height: 50px;
+    padding-left: 20px;
+    padding-right: 20px;
+}
+</style>
+"""
+
+HEADER_HTML = """
+<h1 class="main-header">🚪 EXIT SCANNER</h1>
+<h2 class="college-header">Narsimha Reddy Engineering College</h2>
+"""
+
+BANNER_HTML = """
+<div class="exit-banner">
+    <h2>👋 ORIENTATION DAY CHECK-OUT</h2>
+    <h3>📅 August 18th, 2025</h3>
+    <p><strong>Thank You for Attending!</strong> Scan your QR code to check-out.</p>
+    <p>🚪 <strong>This station is for EXIT ONLY</strong></p>
+</div>
+"""
+
+INSTRUCTIONS_HTML = """
+<div class="instruction-box">
+📌 <strong>Exit Instructions:</strong><br>
+1. <strong>Scan your student QR code</strong> to check-out<br>
+2. Wait for confirmation message<br>
+3. Thank you for attending orientation<br>
+4. Safe journey home!<br>
+5. For entry, use the <strong>ENTRY SCANNER</strong> at the main entrance
+</div>
+"""
+
+FOOTER_HTML = """
+<div style="text-align: center; color: #666; padding: 20px; background-color: #f8f9fa; border-radius: 10px;">
+    <h4>🚪 Exit Scanner Station</h4>
+    <p><strong>NRCM Orientation Day - August 18th, 2025</strong></p>
+    <p style="font-size: 12px; margin-top: 15px;">
+        © 2025 NRCM - Exit Management System
+    </p>
+</div>
+"""
+
+# Blocks are joined without blank lines so markdown keeps them as raw HTML
+PAGE_TOP_HTML = "".join(block.strip("\n") + "\n" for block in
+                        (PAGE_CSS, HEADER_HTML, BANNER_HTML, INSTRUCTIONS_HTML))
+
+PREVIEW_MAX_SIDE = 800  # Decode size for the on-screen preview (2x its display width)
+
+# Stats panel cards: (label, get_exit_statistics key, help text)
+EXIT_METRICS = (
+    ("🚪 Total Exits", "total_exits", "Students who have left"),
+    ("👥 Still Present", "currently_present", "Students still inside"),
+    ("🟢 Total Entries", "total_entries", "Students who entered today"),
+    ("📊 Total Students", "total_students", "Total registered students"),
+)
+
+@st.fragment
+def scanner_fragment(sheet):
+    """Camera/upload scanner; a scan reruns only this fragment"""
+    st.write("### 📱 Camera QR Scanner")
     
-    # Create tabs for different input methods
-    tab1, tab2 = st.tabs(["📱 QR Camera Scanner", "📝 Manual Entry"])
+    col1, col2 = st.columns([3, 2])
     
-    with tab1:
-        st.write("### 📱 Camera QR Scanner")
-        
-        col1, col2 = st.columns([3, 2])
+    with col1:
+        # Primary Camera Scanner
+        st.write("#### 📷 Scan Student QR Code for Exit")
+        camera_image = st.camera_input(
+            "Point camera at student's QR code and take photo",
+            help="Scan when student is leaving the orientation"
+        )
         
-        with col1:
-            # Primary Camera Scanner
-            st.write("#### 📷 Scan Student QR Code for Exit")
-            camera_image = st.camera_input(
-                "Point camera at student's QR code and take photo",
-                help="Scan when student is leaving the orientation"
-            )
+        if camera_image:
+            raw = camera_image.getvalue()
+            digest = image_digest(raw)
             
-            if camera_image:
+            # Reruns keep the last photo around; don't process (or re-send) it twice
+            if st.session_state.get("camera_processed") == digest:
+                st.success("✅ **Already processed.** Take a new photo for the next student.")
+            else:
                 img = Image.open(camera_image)
+                # Preview only: let libjpeg decode at a reduced DCT scale
+                img.draft("RGB", (PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
                 st.image(img, caption="📸 Captured QR Code", width=400)
                 
                 with st.spinner("🔍 Processing exit..."):
-                    qr_data = detect_qr_with_opencv(img)
+                    qr_data = decode_qr_once(raw, digest, "camera_decode")
                 
                 if qr_data:
                     st.success(f"📋 **Scanned Student ID:** {qr_data}")
-                    process_student_exit(qr_data, sheet)
+                    if process_student_exit(qr_data, sheet):
+                        st.session_state["camera_processed"] = digest
                 else:
                     st.error("⚠️ **No QR code detected** in the image.")
                     st.write("**Try again with:**")
                     st.write("• Better lighting")
                     st.write("• QR code fully visible in frame")
                     st.write("• Hold camera steady")
+    
+    with col2:
+        # Exit Status
+        st.write("#### 🚪 Exit Status")
         
-        with col2:
-            # Exit Status
-            st.write("#### 🚪 Exit Status")
-            
-            if not camera_image:
-                st.info("📷 **Ready for check-out**\nScan QR code to record exit")
-            
-            st.write("#### 🚪 Exit Process")
-            st.success("""
-            **✅ Exit Requirements:**
-            • Must have checked-in first
-            • Valid student QR code
-            • Clear scan image
-            • Complete orientation attendance
-            """)
-            
-            st.info("""
-            **📋 What happens on exit:**
-            • Records exit time
-            • Calculates total duration
-            • Shows thank you message
-            • Updates attendance records
-            """)
-            
-            # Alternative upload option
-            st.write("---")
-            st.write("#### 📤 Upload QR Image")
-            uploaded_file = st.file_uploader(
-                "Upload QR Code Photo", 
-                type=['png', 'jpg', 'jpeg'],
-                help="Upload a clear photo of the QR code"
-            )
+        if not camera_image:
+            st.info("📷 **Ready for check-out**\nScan QR code to record exit")
+        
+        st.write("#### 🚪 Exit Process")
+        st.success("""
+        **✅ Exit Requirements:**
+        • Must have checked-in first
+        • Valid student QR code
+        • Clear scan image
+        • Complete orientation attendance
+        """)
+        
+        st.info("""
+        **📋 What happens on exit:**
+        • Records exit time
+        • Calculates total duration
+        • Shows thank you message
+        • Updates attendance records
+        """)
+        
+        # Alternative upload option
+        st.write("---")
+        st.write("#### 📤 Upload QR Image")
+        uploaded_file = st.file_uploader(
+            "Upload QR Code Photo", 
+            type=['png', 'jpg', 'jpeg'],
+            help="Upload a clear photo of the QR code"
+        )
+        
+        if uploaded_file:
+            raw = uploaded_file.getvalue()
+            digest = image_digest(raw)
             
-            if uploaded_file:
+            if st.session_state.get("upload_processed") == digest:
+                st.success("✅ **Already processed.** Upload a new image for the next student.")
+            else:
                 img = Image.open(uploaded_file)
+                img.draft("RGB", (PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE))
                 st.image(img, caption="Uploaded QR Code", width=300)
                 
                 with st.spinner("🔍 Processing exit..."):
-                    qr_data = detect_qr_with_opencv(img)
+                    qr_data = decode_qr_once(raw, digest, "upload_decode")
                 
                 if qr_data:
                     st.success(f"📋 **Scanned ID:** {qr_data}")
-                    process_student_exit(qr_data, sheet)
+                    if process_student_exit(qr_data, sheet):
+                        st.session_state["upload_processed"] = digest
                 else:
                     st.error("⚠️ No QR code detected in uploaded image.")
 
-    with tab2:
-        st.write("### 📝 Manual Student ID Entry")
-        st.info("Use this option if camera scanning is not available.")
-        
-        col1, col2 = st.columns([1, 1])
-        
-        with col1:
-            st.write("#### ✏️ Enter Student ID for Exit")
-            manual_id = st.text_input(
-                "Student ID:", 
-                placeholder="e.g., 2025001",
-                help="Enter the student ID exactly as shown on the ID card"
-            )
-            
-            if st.button("🚪 Process Exit", type="primary", use_container_width=True):
-                if manual_id.strip():
-                    process_student_exit(manual_id.strip(), sheet)
-                else:
-                    st.warning("⚠️ Please enter a valid Student ID.")
+@st.fragment
+def manual_entry_fragment(sheet):
+    """Manual ID entry; typing or submitting reruns only this fragment"""
+    st.write("### 📝 Manual Student ID Entry")
+    st.info("Use this option if camera scanning is not available.")
+    
+    col1, col2 = st.columns([1, 1])
+    
+    with col1:
+        st.write("#### ✏️ Enter Student ID for Exit")
+        manual_id = st.text_input(
+            "Student ID:", 
+            placeholder="e.g., 2025001",
+            help="Enter the student ID exactly as shown on the ID card"
+        )
         
-        with col2:
-            st.write("#### 📊 Manual Exit Guidelines")
-            st.success("""
-            **✅ When to use Manual Entry:**
-            • Camera not working
-            • QR code damaged/unreadable
-            • Student forgot QR code
-            • Technical issues
-            • Emergency situations
-            """)
-            
-            st.warning("""
-            **⚠️ Exit Verification:**
-            • Verify student identity
-            • Check entry status first
-            • Confirm orientation completion
-            • Record any special notes
-            """)
+        if st.button("🚪 Process Exit", type="primary", use_container_width=True):
+            if STUDENT_ID_RE.fullmatch(manual_id.strip()):
+                process_student_exit(manual_id.strip(), sheet)
+            elif manual_id.strip():
+                st.error("❌ **Invalid Student ID format.** IDs are 7 digits starting with 20, e.g. 2025001.")
+            else:
+                st.warning("⚠️ Please enter a valid Student ID.")
     
-    # Exit Statistics
+    with col2:
+        st.write("#### 📊 Manual Exit Guidelines")
+        st.success("""
+        **✅ When to use Manual Entry:**
+        • Camera not working
+        • QR code damaged/unreadable
+        • Student forgot QR code
+        • Technical issues
+        • Emergency situations
+        """)
+        
+        st.warning("""
+        **⚠️ Exit Verification:**
+        • Verify student identity
+        • Check entry status first
+        • Confirm orientation completion
+        • Record any special notes
+        """)
+
+@st.fragment(run_every="30s")
+def stats_fragment(sheet):
+    """Exit statistics panel, refreshed on its own timer"""
     st.write("---")
     st.write("#### 📈 Today's Exit Stats")
     
     # Get real-time statistics
     stats = get_exit_statistics(sheet)
     
-    col1, col2, col3, col4 = st.columns(4)
+    for col, (label, key, help_text) in zip(st.columns(len(EXIT_METRICS)), EXIT_METRICS):
+        with col:
+            st.metric(label, stats[key], help=help_text)
     
-    with col1:
-        st.metric("🚪 Total Exits", stats["total_exits"], help="Students who have left")
-    
-    with col2:
-        st.metric("👥 Still Present", stats["currently_present"], help="Students still inside")
-    
-    with col3:
-        st.metric("🟢 Total Entries", stats["total_entries"], help="Students who entered today")
-    
-    with col4:
-        st.metric("📊 Total Students", stats["total_students"], help="Total registered students")
+    # Exits the background writer couldn't save; rescanning records them again
+    failed = _get_failed_exits()
+    if failed:
+        st.error(f"❌ **Exits not saved to the sheet** for: {', '.join(sorted(failed))}. Please rescan these students.")
     
     # Additional info
     col1, col2 = st.columns(2)
@@ -451,6 +753,56 @@ def main():
         st.metric("⏰ Current Time (IST)", current_ist.strftime("%H:%M:%S"))
     with col2:
         st.metric("📅 Date", current_ist.strftime("%Y-%m-%d"))
+
+def main():
+    st.set_page_config(
+        page_title="NRCM Exit Scanner", 
+        page_icon="🚪", 
+        layout="wide"
+    )
+    
+    # Static CSS, header, banner and instructions in one delta
+    st.markdown(PAGE_TOP_HTML, unsafe_allow_html=True)
+    
+    # Initialize Google Sheets
+    if not GSPREAD_AVAILABLE:
+        st.error("❌ **Google Sheets integration not available**")
+        st.info("To enable Google Sheets functionality, please install required packages:")
+        st.code("pip install gspread google-auth")
+        st.info("**For Streamlit Cloud:** Add these to your requirements.txt file")
+        st.stop()
+    
+    # Cached across reruns and sessions; token refresh is handled by AuthorizedSession
+    sheet = init_google_sheets()
+    if not sheet:
+        # Don't keep a failed connection cached; retry on the next rerun
+        init_google_sheets.clear()
+        st.error("🔧 **Unable to connect to Google Sheets**")
+        st.info("""
+        **For Streamlit Cloud Setup:**
+        1. Go to your app dashboard
+        2. Click Settings → Secrets
+        3. Add your service account JSON under `gcp_service_account`
+        4. Redeploy the app
+        
+        **Service Account Setup:**
+        - Enable Google Sheets API and Google Drive API
+        - Share 'orientation_passes' sheet with service account email
+        - Ensure proper JSON format in secrets
+        """)
+        st.stop()
+    
+    # Create tabs for different input methods
+    tab1, tab2 = st.tabs(["📱 QR Camera Scanner", "📝 Manual Entry"])
+    
+    with tab1:
+        scanner_fragment(sheet)
+    
+    with tab2:
+        manual_entry_fragment(sheet)
+    
+    # Exit Statistics (auto-refreshing fragment)
+    stats_fragment(sheet)
     
     # Exit Information
     st.write("---")
@@ -492,15 +844,7 @@ def main():
     # """)
     
     # Footer
-    st.markdown("""
-    <div style="text-align: center; color: #666; padding: 20px; background-color: #f8f9fa; border-radius: 10px;">
-        <h4>🚪 Exit Scanner Station</h4>
-        <p><strong>NRCM Orientation Day - August 18th, 2025</strong></p>
-        <p style="font-size: 12px; margin-top: 15px;">
-            © 2025 NRCM - Exit Management System
-        </p>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(FOOTER_HTML, unsafe_allow_html=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file